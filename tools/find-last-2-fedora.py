@@ -7,47 +7,180 @@ otherwise it is rawhide.
 """
 
 import os
+import re
 import sys
+import tempfile
+import time
+
+from pathlib import Path
 
 # third_party
 import requests
 
+# local
+from http_session import create_session
+from json_cache import load_json_cache, save_json_cache
+
+_SESSION = create_session()
+
+# The answer only changes a few times a year, so reuse it between runs.
+CACHE_FILE = Path(tempfile.gettempdir()) / "fedora-release.json"
+CACHE_TTL = 6 * 60 * 60  # seconds
+
+# Matches the release number of repository names such as fedora-41.
+RELEASE_RE = re.compile(r"fedora-(\d+)")
+
+
+def is_release(value):
+  return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def is_next_release(value):
+  return value == "rawhide" or is_release(value)
+
+
+def sanitize_cache(cache):
+  """
+  Returns the parts of a loaded cache that have the expected shape. The
+  file lives at a predictable path in the shared temp directory and its
+  releases end up in command line arguments, so nothing else is trusted.
+  """
+  result = {}
+  if is_release(cache.get("latest")) and is_next_release(cache.get("next")):
+    result["latest"] = cache["latest"]
+    result["next"] = cache["next"]
+    ts = cache.get("ts")
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+      result["ts"] = ts
 
-def find_latest_release():
+  http_cache = cache.get("http")
+  result["http"] = {}
+  if not isinstance(http_cache, dict):
+    return result
+  for url, entry in http_cache.items():
+    if not isinstance(entry, dict):
+      continue
+    clean = {
+        key: entry[key]
+        for key in ("etag", "last_modified")
+        if isinstance(entry.get(key), str)
+    }
+    if is_release(entry.get("latest")):
+      clean["latest"] = entry["latest"]
+    if is_release(entry.get("current")) and is_next_release(entry.get("next")):
+      clean["current"] = entry["current"]
+      clean["next"] = entry["next"]
+    result["http"][url] = clean
+  return result
+
+
+def conditional_get(url, validators, **kwargs):
+  """
+  Sends a GET request that can be answered with 304 Not Modified if
+  `validators` holds the ETag or Last-Modified header of a previous
+  response for the same URL.
+  """
+  headers = dict(kwargs.pop("headers", {}))
+  if validators.get("etag"):
+    headers["If-None-Match"] = validators["etag"]
+  if validators.get("last_modified"):
+    headers["If-Modified-Since"] = validators["last_modified"]
+  return _SESSION.get(url, headers=headers, **kwargs)
+
+
+def get_validators(response):
+  return {
+      "etag": response.headers.get("ETag"),
+      "last_modified": response.headers.get("Last-Modified"),
+  }
+
+
+def find_latest_release(http_cache):
+  """
+  `http_cache` maps a URL to the validators of its last response and the
+  value derived from it. It is updated in place.
+  """
   url = "https://endoflife.date/api/fedora.json"
-  r = requests.get(url, headers={"Accept": "application/json"})
+  entry = http_cache.get(url, {})
+  r = conditional_get(url, entry, headers={"Accept": "application/json"})
+  if r.status_code == 304 and "latest" in entry:
+    return entry["latest"]
   r.raise_for_status()
 
-  return int(r.json()[0]["latest"])
+  latest = int(r.json()[0]["latest"])
+  http_cache[url] = {**get_validators(r), "latest": latest}
+  return latest
 
 
-def find_next_release(current):
+def find_next_release(current, http_cache):
   url = "https://mirrors.fedoraproject.org/mirrorlist?repo=nonexistent&arch=x86_64"
-  r = requests.get(url)
+  entry = http_cache.get(url, {})
+  # The cached answer is only valid for the release it was computed for.
+  if entry.get("current") != current:
+    entry = {}
 
-  lines = r.text.split("\n")
-  current_release = f"fedora-{current}"
   found_current = False
-  for line in lines:
-    if current_release in line:
-      found_current = True
-      break
+  found_next = False
+  # Scan the response as it arrives and stop as soon as both are seen.
+  with conditional_get(url, entry, stream=True) as r:
+    if r.status_code == 304 and "next" in entry:
+      return entry["next"]
+    # The repo is nonexistent on purpose: the error page that lists the
+    # available repositories is what is scanned, and it may come with a 4xx
+    # status. Only give up on rate limiting and server errors.
+    if r.status_code == 429 or r.status_code >= 500:
+      r.raise_for_status()
+    # iter_lines() yields bytes unless the response has an encoding.
+    r.encoding = r.encoding or "utf-8"
+    for line in r.iter_lines(decode_unicode=True):
+      # Compare whole numbers, so that e.g. fedora-4 does not match fedora-41.
+      releases = {int(release) for release in RELEASE_RE.findall(line)}
+      found_current = found_current or current in releases
+      found_next = found_next or current + 1 in releases
+      if found_current and found_next:
+        break
+    validators = get_validators(r)
+
   if not found_current:
     raise ValueError(f"Could not find current release {current} in mirrorlist.")
 
-  next_release = f"fedora-{current + 1}"
-  for line in lines:
-    if next_release in line:
-      # Next release is branched, use it
-      return current + 1
+  if found_next:
+    # Next release is branched, use it
+    next_version = current + 1
+  else:
+    # Not branched yet, use rawhide
+    next_version = "rawhide"
 
-  # Not branched yet, use rawhide
-  return "rawhide"
+  http_cache[url] = {**validators, "current": current, "next": next_version}
+  return next_version
 
 
 def main():
-  latest_version = find_latest_release()
-  next_version = find_next_release(latest_version)
+  cache = sanitize_cache(load_json_cache(CACHE_FILE))
+  if "latest" in cache and time.time() - cache.get("ts", 0) < CACHE_TTL:
+    print(f"{cache['latest']} {cache['next']}")
+    return
+
+  http_cache = cache["http"]
+  try:
+    latest_version = find_latest_release(http_cache)
+    next_version = find_next_release(latest_version, http_cache)
+  except (requests.RequestException, ValueError) as e:
+    if "latest" not in cache:
+      raise
+    # Prefer a stale answer over failing when the upstream is unavailable.
+    print(f"Using cached releases from {CACHE_FILE}: {e}", file=sys.stderr)
+    latest_version = cache["latest"]
+    next_version = cache["next"]
+  else:
+    save_json_cache(
+        CACHE_FILE, {
+            "latest": latest_version,
+            "next": next_version,
+            "ts": time.time(),
+            "http": http_cache,
+        })
+
   print(f"{latest_version} {next_version}")
 
 
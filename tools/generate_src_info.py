@@ -1,37 +1,41 @@
 #!/usr/bin/env python3
 
-___doc__ = """
+__doc__ = """
 This script creates several RPM include files for the swift-lang
 RPM package. Swift is a large project with multiple repositories,
 so it's important to keep the dependencies in sync.
-The script clones the Swift repository to a temporary directory,
-reads the config file to get the repositories and branches to update,
-fetches the commit hashes for the specified branches, and generates
-the several include files. The RPM spec file uses these files
-to download the sources and generate the RPM package.
+The script downloads the update-checkout config file of the Swift
+repository for the given scheme (or reads it from --src-dir), gets the
+repositories and branches to update, fetches the commit hashes for the
+specified branches, and generates the several include files. The RPM
+spec file uses these files to download the sources and generate the
+RPM package.
 """
 
 import argparse
-import collections
 import datetime
 import json
 import os
 import shlex
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-# third_party
-import requests
+# local
+from http_session import create_session
+from json_cache import load_json_cache, save_json_cache
 
 ROOT_DIR = Path(os.path.dirname(os.path.realpath(__file__))).parent.resolve()
 
 REPO = "swiftlang/swift"
 REPOSITORY_URL = f"https://github.com/{REPO}"
 REPOSITORY_RAW_URL = f"https://raw.githubusercontent.com/{REPO}"
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
 CONFIG_FILE = "utils/update_checkout/update-checkout-config.json"
 
 # Structure of the CONFIG_FILE:
@@ -54,30 +58,45 @@ CONFIG_FILE = "utils/update_checkout/update-checkout-config.json"
 }
 """
 
+# Number of repositories to query concurrently. The lookups are independent
+# and network bound, so this only needs to be large enough to cover a scheme.
+MAX_FETCH_WORKERS = 16
 
-class PushPopDir:
-  """
-  Context manager to change the current working directory.
-  It is similar to pushd/popd in bash.
-  """
-
-  def __init__(self, new_dir):
-    self.new_dir = new_dir
-    self.old_dir = None
+CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME") or
+                 Path.home() / ".cache") / "swift-lang-rpm"
+# Maps "<username>/<repo>@<branch>" to the last seen ETag and commit hash
+# for the GitHub commits API. A conditional request answered with
+# 304 Not Modified does not count against the rate limit.
+ETAG_CACHE_FILE = CACHE_DIR / "github-etags.json"
+ETAG_CACHE = dict()
+ETAG_CACHE_LOCK = threading.Lock()
+# Maps a scheme to {"<username>/<repo>@<branch>": [commit hash, timestamp]}.
+# Branch heads move, so entries are only trusted for a short time.
+COMMIT_CACHE_FILE = CACHE_DIR / "commits.json"
+COMMIT_CACHE_TTL = 5 * 60  # seconds
 
-  def __enter__(self):
-    self.old_dir = os.getcwd()
-    os.chdir(self.new_dir)
-
-  def __exit__(self, exc_type, exc_value, traceback):
-    os.chdir(self.old_dir)
+# The GraphQL POST is a read-only query, so it is safe to retry.
+_SESSION = create_session(
+    pool_size=MAX_FETCH_WORKERS, allowed_methods=("GET", "POST"))
 
 
 @dataclass
 class Repo:
   name: str
-  remote: str
+  # GitHub owner and repository name, e.g. swiftlang/llvm-project
+  remote_user: str
+  remote_repo: str
   commit: str
+  # Derived from name. It is usable in RPM macro names,
+  # e.g. llvm-project -> llvm_project.
+  safe_name: str = field(init=False)
+
+  def __post_init__(self):
+    self.safe_name = self.name.replace("-", "_")
+
+  @property
+  def remote(self):
+    return f"{self.remote_user}/{self.remote_repo}"
 
 
 SCHEME_VERSION_MAP = {
@@ -101,21 +120,47 @@ def read_checkout_config_from_local(src_dir):
     sys.exit(1)
 
   with open(config_file, "r") as f:
-    return json.load(f, object_pairs_hook=collections.OrderedDict)
+    return json.load(f)
 
 
 def read_checkout_config_from_url(scheme):
   url = f"{REPOSITORY_RAW_URL}/{scheme}/{CONFIG_FILE}"
   print(f"Fetching config file from {url}")
-  r = requests.get(url)
+  r = _SESSION.get(url)
   r.raise_for_status()
   return r.json()
 
 
+def load_etag_cache():
+  cache = load_json_cache(ETAG_CACHE_FILE)
+  with ETAG_CACHE_LOCK:
+    ETAG_CACHE.update(cache)
+
+
+def save_etag_cache():
+  with ETAG_CACHE_LOCK:
+    cache = dict(ETAG_CACHE)
+  save_json_cache(ETAG_CACHE_FILE, cache)
+
+
+def is_commit_hash(value):
+  if not isinstance(value, str) or len(value) != 40:
+    return False
+  try:
+    return len(bytes.fromhex(value)) == 20
+  except ValueError:
+    return False
+
+
+def is_etag_cache_entry(entry):
+  return (isinstance(entry, dict) and isinstance(entry.get("etag"), str) and
+          is_commit_hash(entry.get("sha")))
+
+
 def fetch_github_repo_commit(username, repo, branch, token=None):
   if token:
     return fetch_github_repo_commit_with_token(username, repo, branch, token)
-  return fetch_github_repo_commit_with_clone(username, repo, branch)
+  return fetch_github_repo_commit_with_ls_remote(username, repo, branch)
 
 
 def fetch_github_repo_commit_with_token(username, repo, branch, token):
@@ -123,27 +168,200 @@ def fetch_github_repo_commit_with_token(username, repo, branch, token):
   headers = {}
   if token:
     headers["Authorization"] = f"token {token}"
-  response = requests.get(url, headers=headers)
+
+  key = f"{username}/{repo}@{branch}"
+  with ETAG_CACHE_LOCK:
+    cached = ETAG_CACHE.get(key)
+  # The cache file may be stale or edited by hand; ignore malformed entries.
+  if not is_etag_cache_entry(cached):
+    cached = None
+  if cached:
+    headers["If-None-Match"] = cached["etag"]
+
+  response = _SESSION.get(url, headers=headers)
+  if cached and response.status_code == 304:
+    return cached["sha"]
   response.raise_for_status()
-  return response.json()["sha"]
+  sha = response.json()["sha"]
 
+  etag = response.headers.get("ETag")
+  if etag:
+    with ETAG_CACHE_LOCK:
+      ETAG_CACHE[key] = {"etag": etag, "sha": sha}
+  return sha
 
-def fetch_github_repo_commit_with_clone(username, repo, branch):
-  with tempfile.TemporaryDirectory() as tmp_dir:
-    cmd = [
-        "git", "clone", "-b", branch,
-        f"https://github.com/{username}/{repo}.git", tmp_dir
+
+def fetch_github_repo_commit_with_ls_remote(username, repo, branch):
+  """
+  Resolves the commit with `git ls-remote`, which only exchanges the
+  advertised refs and does not download any objects.
+  `branch` may also name a tag; annotated tags are peeled to their commit.
+  """
+  head_ref = f"refs/heads/{branch}"
+  tag_ref = f"refs/tags/{branch}"
+  peeled_tag_ref = tag_ref + "^{}"
+  cmd = [
+      "git", "ls-remote", f"https://github.com/{username}/{repo}.git", head_ref,
+      tag_ref, peeled_tag_ref
+  ]
+  print(f"Running {shlex.join(cmd)}")
+  output = subprocess.check_output(cmd, text=True)
+
+  refs = dict()
+  for line in output.splitlines():
+    sha, _, ref = line.partition("\t")
+    refs[ref] = sha
+
+  for ref in (head_ref, peeled_tag_ref, tag_ref):
+    if ref in refs:
+      result = refs[ref]
+      break
+  else:
+    raise ValueError(f"Could not find {branch} in {username}/{repo}")
+
+  if not is_commit_hash(result):
+    raise ValueError(f"Invalid commit hash: {result}")
+  return result
+
+
+def fetch_github_repo_commits_with_graphql(targets, token):
+  """
+  Resolves all targets with a single GraphQL query, using one aliased
+  `repository` field per target. Returns a dict mapping the repository
+  name to the commit hash; targets GitHub could not resolve to a commit
+  (e.g. unknown refs or annotated tags) are left out of the result.
+  """
+  aliases = dict()
+  fields = []
+  for index, (name, (username, repo, branch)) in enumerate(targets.items()):
+    alias = f"r{index}"
+    aliases[alias] = name
+    # JSON string literals are valid GraphQL string literals.
+    fields.append(f"{alias}: repository(owner: {json.dumps(username)}, "
+                  f"name: {json.dumps(repo)}) {{ "
+                  f"object(expression: {json.dumps(branch)}) {{ "
+                  f"... on Commit {{ oid }} }} }}")
+  query = "query { " + " ".join(fields) + " }"
+
+  headers = {"Authorization": f"bearer {token}"}
+  print(f"Querying {len(targets)} repositories from {GITHUB_GRAPHQL_URL}")
+  response = _SESSION.post(
+      GITHUB_GRAPHQL_URL, headers=headers, json={"query": query})
+  response.raise_for_status()
+  body = response.json()
+  data = body.get("data") or {}
+
+  # GitHub reports rate limiting, bad credentials and unknown repositories
+  # as errors in the body rather than through the status code. Report them
+  # so that a failed query is not silently replaced by the REST fallback.
+  for error in body.get("errors") or []:
+    path = error.get("path") or []
+    name = aliases.get(path[0]) if path else None
+    prefix = f"GraphQL error for {name}" if name else "GraphQL error"
+    print(f"{prefix}: {error.get('message', error)}")
+
+  result = dict()
+  for alias, name in aliases.items():
+    repository = data.get(alias) or {}
+    commit = (repository.get("object") or {}).get("oid")
+    if commit:
+      result[name] = commit
+  return result
+
+
+def fetch_github_repo_commits(targets, token=None):
+  """
+  Fetches the commit hashes for the given targets.
+  `targets` maps a repository name to a (username, repo, branch) tuple.
+  Returns a dict mapping the repository name to the commit hash.
+  With a token, all targets are resolved with one GraphQL query first;
+  whatever is left is fetched concurrently, one lookup per repository.
+  If any lookup fails, the first exception (in target order) is re-raised.
+  """
+  result = dict()
+  if token:
+    result = fetch_github_repo_commits_with_graphql(targets, token)
+
+  remaining = {
+      name: target for name, target in targets.items() if name not in result
+  }
+  if remaining:
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+      futures = {
+          name:
+              executor.submit(fetch_github_repo_commit, username, repo, branch,
+                              token)
+          for name, (username, repo, branch) in remaining.items()
+      }
+      for name, future in futures.items():
+        result[name] = future.result()
+
+  return {name: result[name] for name in targets}
+
+
+def is_commit_cache_entry(entry):
+  # Entries are [commit hash, timestamp]; anything else is a miss.
+  return (isinstance(entry, list) and len(entry) == 2 and
+          is_commit_hash(entry[0]) and isinstance(entry[1], (int, float)) and
+          not isinstance(entry[1], bool))
+
+
+def fetch_github_repo_commits_cached(scheme, targets, token=None):
+  """
+  Same as fetch_github_repo_commits, but reuses the commits resolved by a
+  previous run for the same scheme if they are younger than
+  COMMIT_CACHE_TTL.
+  """
+  commit_cache = load_json_cache(COMMIT_CACHE_FILE)
+  scheme_cache = commit_cache.get(scheme)
+  if not isinstance(scheme_cache, dict):
+    scheme_cache = dict()
+    commit_cache[scheme] = scheme_cache
+  now = time.time()
+
+  result = dict()
+  for name, (username, repo, branch) in targets.items():
+    entry = scheme_cache.get(f"{username}/{repo}@{branch}")
+    if is_commit_cache_entry(entry) and now - entry[1] < COMMIT_CACHE_TTL:
+      result[name] = entry[0]
+
+  remaining = {
+      name: target for name, target in targets.items() if name not in result
+  }
+  if remaining:
+    result.update(fetch_github_repo_commits(remaining, token))
+    for name, (username, repo, branch) in remaining.items():
+      scheme_cache[f"{username}/{repo}@{branch}"] = [result[name], now]
+    save_json_cache(COMMIT_CACHE_FILE, commit_cache)
+
+  return {name: result[name] for name in targets}
+
+
+def write_file_if_changed(path, content):
+  # Leave the file (and its mtime) alone if nothing changed, so that
+  # consumers of the generated files do not see a spurious update.
+  try:
+    if path.read_text() == content:
+      print(f"{path} is up to date.")
+      return
+  except OSError:
+    pass
+  path.write_text(content)
+
+
+def write_files(files):
+  """
+  Writes the given {path: content} files, skipping the ones that already
+  have the same content. The files are independent of each other, so they
+  are written concurrently.
+  """
+  with ThreadPoolExecutor(max_workers=len(files)) as executor:
+    futures = [
+        executor.submit(write_file_if_changed, path, content)
+        for path, content in files.items()
     ]
-    print(f"Running {shlex.join(cmd)}")
-    subprocess.run(cmd, check=True)
-    with PushPopDir(tmp_dir):
-      cmd = ["git", "rev-parse", "HEAD"]
-      print(f"Running {shlex.join(cmd)}")
-      result = subprocess.check_output(cmd, text=True).strip()
-      # Check if the result is a valid commit hash
-      if len(result) != 40 or not all(c in "0123456789abcdef" for c in result):
-        raise ValueError(f"Invalid commit hash: {result}")
-      return result
+    for future in futures:
+      future.result()
 
 
 def main():
@@ -153,6 +371,10 @@ def main():
   parser.add_argument(
       "--no-write", action="store_true", help="do not write to file")
   parser.add_argument("--github-token", help="GitHub token")
+  parser.add_argument(
+      "--no-cache",
+      action="store_true",
+      help="do not reuse commits resolved by a previous run")
 
   args = parser.parse_args()
 
@@ -199,7 +421,7 @@ def main():
   if "ninja" in scheme_repos:
     scheme_repos.pop("ninja")
 
-  repo_map = dict()
+  targets = dict()
   for repo, branch in scheme_repos.items():
     if repo not in repos:
       print(f"Repository {repo} not found in the config file.")
@@ -207,18 +429,34 @@ def main():
 
     remote = repos[repo]["remote"]["id"]
     git_username, git_repo = remote.split("/", maxsplit=1)
-    commit = fetch_github_repo_commit(git_username, git_repo, branch, token)
-    repo_map[repo] = Repo(repo, remote, commit)
+    targets[repo] = (git_username, git_repo, branch)
+
+  if token:
+    load_etag_cache()
+  if args.no_cache:
+    commits = fetch_github_repo_commits(targets, token)
+  else:
+    commits = fetch_github_repo_commits_cached(scheme, targets, token)
+  if token:
+    save_etag_cache()
+
+  repo_map = dict()
+  for repo, (git_username, git_repo, _) in targets.items():
+    repo_map[repo] = Repo(repo, git_username, git_repo, commits[repo])
 
   if not write_to_file:
-    print(json.dumps([repo.__dict__ for repo in repo_map.values()], indent=2))
+    # Only print the fields read from the config file and GitHub
+    summary = [{
+        "name": repo.name,
+        "remote": repo.remote,
+        "commit": repo.commit
+    } for repo in repo_map.values()]
+    print(json.dumps(summary, indent=2))
     return 0
 
   swift_commit = repo_map["swift"].commit
   # Sort the repositories by name, to ensure consistent output
-  result = []
-  for repo_name in sorted(repo_map.keys()):
-    result.append(repo_map[repo_name])
+  result = sorted(repo_map.values(), key=lambda repo: repo.name)
 
   utcnow = datetime.datetime.now(datetime.UTC)
   date = utcnow.strftime("%Y%m%d")
@@ -226,37 +464,39 @@ def main():
   # Version format: <version>~pre^<date>git<commit>
   version = f"{scheme_to_version}~pre^{date}git{swift_commit[:7]}"
 
-  versio_inc = f"""%global swift_version {version}
-%global package_version {scheme_to_version}
-
-"""
+  version_parts = [
+      f"%global swift_version {version}\n",
+      f"%global package_version {scheme_to_version}\n",
+      "\n",
+  ]
   for item in result:
-    versio_inc += f"%global {item.name.replace('-', '_')}_commit {item.commit}\n"
-
-  with open(ROOT_DIR / "version.inc", "w") as f:
-    f.write(versio_inc)
+    version_parts.append(f"%global {item.safe_name}_commit {item.commit}\n")
+  versio_inc = "".join(version_parts)
 
-  source_inc = ""
+  source_parts = []
   for index, item in enumerate(result):
     # Source index starts from 3 since first 3 sources are already defined
     # for .inc files
-    source_inc += f"Source{index+3}: https://github.com/{item.remote}/archive/"
-    source_inc += "%{" + item.name.replace('-', '_') + "_commit}.tar.gz#/"
-    source_inc += item.name + "-%{" + item.name.replace(
-        '-', '_') + "_commit}.tar.gz\n"
-
-  with open(ROOT_DIR / "source.inc", "w") as f:
-    f.write(source_inc)
-
-  rename_inc = ""
+    source_parts.append(
+        f"Source{index+3}: https://github.com/{item.remote_user}/"
+        f"{item.remote_repo}/archive/")
+    source_parts.append("%{" + item.safe_name + "_commit}.tar.gz#/")
+    source_parts.append(item.name + "-%{" + item.safe_name +
+                        "_commit}.tar.gz\n")
+  source_inc = "".join(source_parts)
+
+  rename_parts = []
   for item in result:
-    git_repo = item.remote.split("/", maxsplit=1)[1]
-    rename_inc += "mv " + git_repo + "-%{" + item.name.replace(
-        '-', '_') + "_commit} "
-    rename_inc += item.name + "\n"
-
-  with open(ROOT_DIR / "rename.inc", "w") as f:
-    f.write(rename_inc)
+    rename_parts.append("mv " + item.remote_repo + "-%{" + item.safe_name +
+                        "_commit} ")
+    rename_parts.append(item.name + "\n")
+  rename_inc = "".join(rename_parts)
+
+  write_files({
+      ROOT_DIR / "version.inc": versio_inc,
+      ROOT_DIR / "source.inc": source_inc,
+      ROOT_DIR / "rename.inc": rename_inc,
+  })
 
   print("All files generated successfully.")
 
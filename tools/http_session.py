@@ -0,0 +1,36 @@
+__doc__ = """
+Shared HTTP session setup for the scripts in this directory. The scripts
+are run from tools/, which puts this directory on sys.path, so they can
+import this module directly.
+"""
+
+# third_party
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session(pool_size=DEFAULT_POOLSIZE, allowed_methods=("GET",)):
+  """
+  Creates a requests session that keeps connections alive between calls and
+  retries transient server errors and rate limiting with exponential
+  backoff.
+  `pool_size` should cover the number of threads sharing the session.
+  Only requests using `allowed_methods` are retried; add "POST" only for
+  requests that are safe to send more than once.
+  """
+  session = requests.Session()
+  # raise_on_status=False hands the last response back, so callers still
+  # report it through raise_for_status().
+  retry = Retry(
+      total=5,
+      backoff_factor=0.5,
+      status_forcelist=[429, 502, 503, 504],
+      allowed_methods=list(allowed_methods),
+      raise_on_status=False)
+  session.mount(
+      "https://",
+      HTTPAdapter(
+          pool_connections=pool_size, pool_maxsize=pool_size,
+          max_retries=retry))
+  return session
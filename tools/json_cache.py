@@ -0,0 +1,47 @@
+__doc__ = """
+Small JSON file cache helpers shared by the scripts in this directory.
+Callers are expected to validate the loaded contents, since cache files
+may be stale, truncated by hand or written by another version.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+
+
+def load_json_cache(path):
+  """Returns the dict stored at `path`, or an empty dict if there is none."""
+  try:
+    with open(path, "r") as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return dict()
+  if not isinstance(cache, dict):
+    return dict()
+  return cache
+
+
+def save_json_cache(path, cache):
+  """
+  Stores `cache` at `path`. The data is written to a unique temporary file
+  first and then renamed, so that concurrent runs never read or install a
+  partially written cache. Failures are reported but not raised, since a
+  cache is never required.
+  """
+  try:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+  except OSError as e:
+    print(f"Failed to write {path}: {e}", file=sys.stderr)
+    return
+
+  try:
+    with os.fdopen(fd, "w") as f:
+      json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, path)
+  except OSError as e:
+    with contextlib.suppress(OSError):
+      os.unlink(tmp_file)
+    print(f"Failed to write {path}: {e}", file=sys.stderr)
@@ -7,10 +7,28 @@ intended to be used by CI scripts to send notifications to Slack.
 
 import argparse
 import json
+import os
 import sys
 
-# third_party
-import requests
+# local
+from http_session import create_session
+
+# Webhook POSTs are not retried: a retry after a read timeout could post the
+# same message twice.
+_SESSION = create_session()
+
+# Slack truncates message text after 40,000 characters. Only the end of the
+# input file is sent, leaving room for the message itself.
+MAX_INPUT_BYTES = 38000
+
+
+def read_file_tail(path, limit):
+  """Reads at most the last `limit` bytes of a file as text."""
+
+  with open(path, "rb") as f:
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - limit))
+    return f.read().decode("utf-8", errors="replace")
 
 
 def main():
@@ -30,9 +48,8 @@ def main():
   # Add content from input file if provided
   if args.input:
     try:
-      with open(args.input, 'r') as f:
-        file_content = f.read()
-        message["text"] += "\n```" + file_content + "```"
+      file_content = read_file_tail(args.input, MAX_INPUT_BYTES)
+      message["text"] += "\n```" + file_content + "```"
     except FileNotFoundError:
       print(f"Error: Could not read file {args.input}")
       message["text"] += "\nError: Could not read file"
@@ -47,7 +64,7 @@ def send_slack_message(url, message):
   headers = {"Content-Type": "application/json"}
   data = json.dumps(message).encode("utf-8")
 
-  response = requests.post(url, headers=headers, data=data)
+  response = _SESSION.post(url, headers=headers, data=data, timeout=10)
   response.raise_for_status()
 
 